@@ -2,19 +2,21 @@ from __future__ import annotations
 
 import argparse
 import json
-from dataclasses import asdict, is_dataclass
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, is_dataclass
 from datetime import datetime
-from functools import partial
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from functools import lru_cache, partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from sqless_agent.agent import MetricAgent
 from sqless_agent.clarification import ClarificationEngine
 from sqless_agent.gate import UncertaintyGate
-from sqless_agent.models import ClarificationAnswer, ParsedIntent, SessionState
+from sqless_agent.models import ClarificationAnswer, MetricSpec, ParsedIntent, SessionState
 from sqless_agent.sample_data import build_default_specs
-from sqless_agent.stores import AssetStore
+from sqless_agent.stores import AssetStore, build_preview
 
 # Initialize store and agent with sample data
 store = AssetStore()
@@ -23,44 +25,132 @@ for spec in build_default_specs():
 
 agent = MetricAgent(store, owners=["owner@datateam.com", "lead@datateam.com"])
 clarifier = ClarificationEngine()
+store.subscribe(clarifier.invalidate)
 uncertainty_gate = UncertaintyGate()
 
 sessions: Dict[str, SessionState] = {}
+# Requests are served from several threads: ``sessions_guard`` protects the two
+# registries, while each session gets its own lock so turns on one session are
+# serialized without blocking other sessions.
+session_locks: Dict[str, threading.Lock] = {}
+sessions_guard = threading.Lock()
+# Built once: json.dumps with custom options creates a new encoder on every call.
+# Raw UTF-8 and compact separators roughly halve payloads full of Chinese labels.
+json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
 ROOT = Path(__file__).resolve().parent
 STATIC_ROOT = ROOT / "static"
 
 
+def _iso_dict_factory(items):
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in items}
+
+
 def serialize(obj):
+    # asdict calls the factory for every nested dataclass, so datetimes are
+    # converted while the copy is built instead of in a second walk.
     if is_dataclass(obj):
-        data = asdict(obj)
-    elif isinstance(obj, list):
+        return asdict(obj, dict_factory=_iso_dict_factory)
+    if isinstance(obj, list):
         return [serialize(item) for item in obj]
-    elif isinstance(obj, dict):
+    if isinstance(obj, dict):
         return {k: serialize(v) for k, v in obj.items()}
-    else:
-        return obj
+    return obj
 
-    for key, value in list(data.items()):
-        if isinstance(value, datetime):
-            data[key] = value.isoformat()
-        else:
-            data[key] = serialize(value)
-    return data
+
+def register_session(state: SessionState) -> None:
+    with sessions_guard:
+        sessions[state.session_id] = state
+        session_locks[state.session_id] = threading.Lock()
 
 
-def summarize_spec(spec, state=None):
-    working_state = state or SessionState(
-        session_id="preview",
-        user="preview",
-        intent=ParsedIntent(raw_query="", metrics=[], dimensions=[], time_range=None, granularity=None),
-    )
-    sql_preview = agent.sql_generator.render(spec, working_state)
-    sql_lines = sql_preview.splitlines()
-    friendly_slots = clarifier._slot_values_for_spec(spec)
+@contextmanager
+def locked_session(session_id: Optional[str]) -> Iterator[Optional[SessionState]]:
+    """Yield the session while holding its lock, or ``None`` if it is unknown."""
+    with sessions_guard:
+        state = sessions.get(session_id)
+        lock = session_locks.get(session_id)
+    if state is None or lock is None:
+        yield None
+        return
+    with lock:
+        yield state
+
+
+def _preview_key(state: Optional[SessionState]) -> Tuple[Optional[str], Tuple[Tuple[str, str], ...]]:
+    """The parts of a session the SQL preview reads: time range and clarified slots."""
+    if state is None:
+        return None, ()
+    # Answers arrive unvalidated (missing slot, list values); the SQL renders them
+    # through str(), so stringify both parts to keep the key sortable and hashable.
+    clarified = tuple(sorted((str(slot), str(ans.value)) for slot, ans in state.clarifications.items()))
+    return state.intent.time_range, clarified
+
+
+class SpecRef:
+    """Cache key for one spec object: previews must describe the spec a session holds.
+
+    A re-added spec is a different object, so sessions that picked the old one keep
+    previews that match the SQL ``generate`` will render from it. The cache entry
+    holds the spec, so its ``id()`` cannot be reused while the key is alive.
+    """
+
+    __slots__ = ("spec", "_key")
+
+    def __init__(self, spec: MetricSpec) -> None:
+        self.spec = spec
+        self._key = (spec.spec_id, spec.governance.version, id(spec))
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, SpecRef) and other._key == self._key
+
+
+def _preview_for(spec: MetricSpec) -> Dict:
+    """The store's prebuilt preview when ``spec`` is the indexed object, else built fresh."""
+    if store.specs.get(spec.spec_id) is spec:
+        return store.previews[spec.spec_id]
+    return build_preview(spec)
+
+
+@dataclass(frozen=True)
+class RenderedSql:
+    head: Tuple[str, ...]
+    snippet: str
+
+
+@lru_cache(maxsize=512)
+def _render_sql_cached(
+    ref: SpecRef, time_range: Optional[str], clarified: Tuple[Tuple[str, str], ...]
+) -> RenderedSql:
+    """First four SQL lines for previews; the full statement is only rendered on generate."""
+    working_state = None
+    if time_range or clarified:
+        # Rebuild just the inputs the preview reads; candidate previews outside a
+        # session skip this and render from the spec alone.
+        working_state = SessionState(
+            session_id="preview",
+            user="preview",
+            intent=ParsedIntent(raw_query="", metrics=[], dimensions=[], time_range=time_range, granularity=None),
+            clarifications={slot: ClarificationAnswer(slot=slot, value=value) for slot, value in clarified},
+        )
+    head = tuple(agent.sql_generator.render_preview(ref.spec, working_state))
+    return RenderedSql(head=head, snippet="\n".join(head))
+
+
+@lru_cache(maxsize=512)
+def _summarize_spec_cached(
+    ref: SpecRef, time_range: Optional[str], clarified: Tuple[Tuple[str, str], ...]
+) -> Dict:
+    spec = ref.spec
+    rendered = _render_sql_cached(ref, time_range, clarified)
+    preview = _preview_for(spec)
+    friendly_slots = preview["friendly_slots"]
     return {
         "spec_id": spec.spec_id,
         "name": spec.meta.name,
-        "summary": spec.summary(),
+        "summary": preview["summary"],
         "status": spec.meta.status,
         "owner": spec.meta.owner,
         "version": spec.governance.version,
@@ -68,7 +158,7 @@ def summarize_spec(spec, state=None):
         "tags": spec.meta.tags,
         "time_granularity": spec.semantics.grain.time_granularity,
         "dimensions": spec.semantics.grain.dimensions,
-        "filters": [f.desc or f.expr for f in spec.semantics.filters],
+        "filters": preview["filter_labels"],
         "data_source": spec.physical.fact_table,
         "time_column": spec.physical.time_column,
         "measure": spec.physical.measure_column,
@@ -78,15 +168,33 @@ def summarize_spec(spec, state=None):
         + (f" (v{spec.semantics.industry_mapping.version})" if spec.semantics.industry_mapping else "")
         if friendly_slots.get("industry_mapping")
         else None,
-        "sql_snippet": "\n".join(sql_lines[:4]),
+        "sql_snippet": rendered.snippet,
     }
 
 
+def _drop_preview_caches(spec_id: str) -> None:
+    # Covers specs edited in place and re-added as the same object; lru_cache cannot
+    # evict by spec_id and re-adds are rare, so clear both wholesale.
+    _render_sql_cached.cache_clear()
+    _summarize_spec_cached.cache_clear()
+
+
+store.subscribe(_drop_preview_caches)
+
+
+def summarize_spec(spec, state=None):
+    # Summaries are reused across turns and sessions until the preview inputs change;
+    # status is overlaid because the store can verify a spec in place.
+    cached = _summarize_spec_cached(SpecRef(spec), *_preview_key(state))
+    return {**cached, "status": spec.meta.status}
+
+
 def confirmation_payload(state: SessionState):
     if not state.selected_spec:
         return None
     spec = state.selected_spec
-    friendly_slots = clarifier._slot_values_for_spec(spec)
+    preview = _preview_for(spec)
+    friendly_slots = preview["friendly_slots"]
     mapping_label = friendly_slots.get("industry_mapping") or "未指定"
     if spec.semantics.industry_mapping:
         mapping_label = f"{mapping_label} (v{spec.semantics.industry_mapping.version})"
@@ -98,7 +206,7 @@ def confirmation_payload(state: SessionState):
         "time_range": state.intent.time_range or "未指定",
         "time_semantics": time_label,
         "industry_mapping": mapping_label,
-        "filters": [f.desc or f.expr for f in spec.semantics.filters],
+        "filters": preview["filter_labels"],
         "source": spec.physical.fact_table,
         "owner": spec.meta.owner,
         "caliber": spec.semantics.metric_caliber,
@@ -120,7 +228,8 @@ def expert_card_payload(state: SessionState):
     labels = ["推测 A", "推测 B"]
     for idx, cand in enumerate(top_candidates):
         spec = cand.spec
-        friendly_slots = clarifier._slot_values_for_spec(spec)
+        preview = _preview_for(spec)
+        friendly_slots = preview["friendly_slots"]
         options.append(
             {
                 "label": labels[idx] if idx < len(labels) else f"推测 {idx + 1}",
@@ -128,13 +237,13 @@ def expert_card_payload(state: SessionState):
                 "definition": spec.meta.description,
                 "business_hint": friendly_slots.get("metric_caliber") or spec.semantics.metric_caliber,
                 "source": f"{spec.physical.fact_table}.{spec.physical.measure_column}",
-                "filters": [f.desc or f.expr for f in spec.semantics.filters],
+                "filters": preview["filter_labels"],
                 "spec_id": spec.spec_id,
-                "snippet": agent.sql_generator.render(spec, state).splitlines()[:4],
+                "snippet": list(_render_sql_cached(SpecRef(spec), *_preview_key(state)).head),
             }
         )
     return {
-        "title": "\ud83d\udcca 数据口径确认请求",
+        "title": "\U0001f4ca 数据口径确认请求",
         "source_user": state.user,
         "original_query": state.intent.raw_query,
         "reason": reason,
@@ -170,6 +279,10 @@ def session_payload(state: SessionState, questions: Optional[List] = None, sql:
 
 
 class APIServerHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps the browser's connection open across the clarify/select/generate
+    # calls of one page; every response below carries an explicit Content-Length.
+    protocol_version = "HTTP/1.1"
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=str(ROOT), **kwargs)
 
@@ -181,6 +294,7 @@ class APIServerHandler(SimpleHTTPRequestHandler):
 
     def do_OPTIONS(self):
         self.send_response(204)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
@@ -204,14 +318,16 @@ class APIServerHandler(SimpleHTTPRequestHandler):
         if not raw:
             return {}
         try:
-            return json.loads(raw.decode("utf-8"))
+            return json.loads(raw)
         except json.JSONDecodeError:
             return {}
 
     def _json_response(self, payload, status=200):
-        body = json.dumps(payload).encode("utf-8")
+        # Lone surrogates from "\udXXX" escapes in request JSON are echoed back;
+        # backslashreplace writes them as the same JSON escape instead of raising.
+        body = json_encoder.encode(payload).encode("utf-8", "backslashreplace")
         self.send_response(status)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         self.wfile.write(body)
@@ -220,74 +336,75 @@ class APIServerHandler(SimpleHTTPRequestHandler):
         query = payload.get("query", "")
         user = payload.get("user", "guest")
         state = agent.start_session(query, user)
-        sessions[state.session_id] = state
         questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
-        return session_payload(state, questions=questions)
+        response = session_payload(state, questions=questions)
+        register_session(state)
+        return response
 
     def _handle_clarify(self, payload):
         session_id = payload.get("session_id")
         answers_payload = payload.get("answers", [])
-        state = sessions.get(session_id)
-        if not state:
-            return {"error": "session not found"}, 404
-        answers = [ClarificationAnswer(slot=a.get("slot"), value=a.get("value")) for a in answers_payload]
-        agent.clarify(state, answers)
-        questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
-        return session_payload(state, questions=questions), 200
+        with locked_session(session_id) as state:
+            if not state:
+                return {"error": "session not found"}, 404
+            answers = [ClarificationAnswer(slot=a.get("slot"), value=a.get("value")) for a in answers_payload]
+            agent.clarify(state, answers)
+            questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
+            return session_payload(state, questions=questions), 200
 
     def _handle_expert_decision(self, payload):
         session_id = payload.get("session_id")
         action = payload.get("action")
-        state = sessions.get(session_id)
-        if not state:
-            return {"error": "session not found"}, 404
-        if action == "confirm":
-            spec_id = payload.get("spec_id")
-            match = next((c for c in state.candidates if c.spec.spec_id == spec_id), None)
-            if not match:
-                return {"error": "spec not found"}, 400
-            agent.apply_expert_decision(state, match)
-        elif action == "revise":
-            answers_payload = payload.get("answers", [])
-            answers = [ClarificationAnswer(slot=a.get("slot"), value=a.get("value")) for a in answers_payload]
-            agent.clarify(state, answers)
-            state.route_expert = False
-        elif action == "forward":
-            state.forwarded_to = payload.get("forward_to") or ""
-        questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
-        return session_payload(state, questions=questions), 200
+        with locked_session(session_id) as state:
+            if not state:
+                return {"error": "session not found"}, 404
+            if action == "confirm":
+                spec_id = payload.get("spec_id")
+                match = state.candidate_by_id.get(spec_id)
+                if not match:
+                    return {"error": "spec not found"}, 400
+                agent.apply_expert_decision(state, match)
+            elif action == "revise":
+                answers_payload = payload.get("answers", [])
+                answers = [ClarificationAnswer(slot=a.get("slot"), value=a.get("value")) for a in answers_payload]
+                agent.clarify(state, answers)
+                state.route_expert = False
+            elif action == "forward":
+                state.forwarded_to = payload.get("forward_to") or ""
+            questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
+            return session_payload(state, questions=questions), 200
 
     def _handle_resolve_conflict(self, payload):
         session_id = payload.get("session_id")
         option_id = payload.get("option_id")
-        state = sessions.get(session_id)
-        if not state:
-            return {"error": "session not found"}, 404
-        agent.resolve_conflict(state, option_id)
-        questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
-        return session_payload(state, questions=questions), 200
+        with locked_session(session_id) as state:
+            if not state:
+                return {"error": "session not found"}, 404
+            agent.resolve_conflict(state, option_id)
+            questions = clarifier.next_questions(state) if uncertainty_gate.needs_clarification(state) else []
+            return session_payload(state, questions=questions), 200
 
     def _handle_select(self, payload):
         session_id = payload.get("session_id")
         spec_id = payload.get("spec_id")
-        state = sessions.get(session_id)
-        if not state:
-            return {"error": "session not found"}, 404
-        match = next((c for c in state.candidates if c.spec.spec_id == spec_id), None)
-        if not match:
-            return {"error": "spec not in candidate list"}, 400
-        state.selected_spec = match.spec
-        store.bump_usage(match.spec.spec_id)
-        return session_payload(state, questions=clarifier.next_questions(state)), 200
+        with locked_session(session_id) as state:
+            if not state:
+                return {"error": "session not found"}, 404
+            match = state.candidate_by_id.get(spec_id)
+            if not match:
+                return {"error": "spec not in candidate list"}, 400
+            state.selected_spec = match.spec
+            store.bump_usage(match.spec.spec_id)
+            return session_payload(state, questions=clarifier.next_questions(state)), 200
 
     def _handle_generate_sql(self, payload):
         session_id = payload.get("session_id")
-        state = sessions.get(session_id)
-        if not state:
-            return {"error": "session not found"}, 404
-        sql = agent.generate_sql(state)
-        store.bump_usage(state.selected_spec.spec_id)  # type: ignore[arg-type]
-        return session_payload(state, sql=sql), 200
+        with locked_session(session_id) as state:
+            if not state:
+                return {"error": "session not found"}, 404
+            sql = agent.generate_sql(state)
+            store.bump_usage(state.selected_spec.spec_id)  # type: ignore[arg-type]
+            return session_payload(state, sql=sql), 200
 
     def do_POST(self):
         handlers = {
@@ -315,7 +432,8 @@ class APIServerHandler(SimpleHTTPRequestHandler):
 # Entry point
 
 def run(host: str = "0.0.0.0", port: int = 8000):
-    server = HTTPServer((host, port), partial(APIServerHandler))
+    # One thread per connection so a slow request does not stall other browser tabs.
+    server = ThreadingHTTPServer((host, port), partial(APIServerHandler))
     print(f"Serving SQLess UI at http://{host}:{port}")
     print("Press Ctrl+C to stop.")
     try:
@@ -24,7 +24,9 @@ class MetricAgent:
         self.selector = CandidateSelector(store)
         self.gate = UncertaintyGate()
         self.clarifier = ClarificationEngine()
+        store.subscribe(self.clarifier.invalidate)
         self.sql_generator = SQLGenerator()
+        store.subscribe(self.sql_generator.invalidate)
         self.expert_router = ExpertRouter(list(owners or []))
         self.expert_feedback = ExpertFeedbackApplier()
         self.conflict_detector = ConflictDetector()
@@ -34,12 +36,16 @@ class MetricAgent:
         session = SessionState(session_id=str(uuid.uuid4()), user=user, intent=intent)
         session.conflict = self.conflict_detector.detect(intent)
         keywords = intent.metrics or [query]
-        session.candidates = self.selector.retrieve(keywords)
+        self.set_candidates(session, self.selector.retrieve_raw(keywords))
         self.gate.evaluate(session)
         if session.conflict:
             session.route_expert = True
         return session
 
+    def set_candidates(self, state: SessionState, candidates: List[Candidate]) -> None:
+        state.candidates = candidates
+        state.candidate_by_id = {cand.spec.spec_id: cand for cand in candidates}
+
     def clarify(self, state: SessionState, answers: Iterable[ClarificationAnswer]) -> None:
         self.clarifier.apply_answers(state, answers)
         if state.candidates:
@@ -1,94 +1,138 @@
 from __future__ import annotations
 
+import sys
 from collections import Counter
 from typing import Dict, Iterable, List
 
-from .models import ClarificationAnswer, ClarificationQuestion, SessionState
+from .models import ClarificationAnswer, ClarificationQuestion, MetricSpec, SessionState
+
+# Slot labels shared by the question bank and the spec-derived slot values, so
+# every occurrence is the same string object.
+CATEGORY_INDUSTRY = "类目行业"
+MERCHANT_INDUSTRY = "商家行业"
+CONTENT_INDUSTRY = "内容行业"
+NATURAL_DAY = "自然日(UTC+8)"
+BUSINESS_DAY = "业务日"
+
+
+QUESTION_BANK: List[ClarificationQuestion] = [
+    ClarificationQuestion(
+        slot="metric_caliber",
+        question="请选择 GMV 口径",
+        options=["下单", "支付", "结算"],
+        recommended="支付",
+    ),
+    ClarificationQuestion(
+        slot="industry_mapping",
+        question="请选择行业定义",
+        options=[CATEGORY_INDUSTRY, MERCHANT_INDUSTRY, CONTENT_INDUSTRY],
+        recommended=CATEGORY_INDUSTRY,
+    ),
+    ClarificationQuestion(
+        slot="time_semantics",
+        question="请选择时间口径",
+        options=[NATURAL_DAY, BUSINESS_DAY],
+        recommended=NATURAL_DAY,
+    ),
+]
+QUESTION_BANK_BY_SLOT: Dict[str, ClarificationQuestion] = {q.slot: q for q in QUESTION_BANK}
+
+
+def slot_values_for_spec(spec: MetricSpec) -> Dict[str, str]:
+    """Clarification slot values a spec implies, in the question bank's labels."""
+    values: Dict[str, str] = {}
+    if spec.semantics.metric_caliber:
+        # Calibers may come from loaded assets; intern them like the literal labels.
+        values["metric_caliber"] = sys.intern(spec.semantics.metric_caliber)
+    if spec.semantics.industry_mapping:
+        dim_table = spec.semantics.industry_mapping.dim_table
+        values["industry_mapping"] = (
+            MERCHANT_INDUSTRY if "merchant" in dim_table or "shop" in dim_table else CATEGORY_INDUSTRY
+        )
+    if spec.semantics.time_semantics:
+        rule = spec.semantics.time_semantics.business_day_rule
+        values["time_semantics"] = NATURAL_DAY if "natural" in rule else BUSINESS_DAY
+    return values
 
 
 class ClarificationEngine:
     """Generates low-friction clarification questions and applies answers."""
 
-    QUESTION_BANK: List[ClarificationQuestion] = [
-        ClarificationQuestion(
-            slot="metric_caliber",
-            question="请选择 GMV 口径",
-            options=["下单", "支付", "结算"],
-            recommended="支付",
-        ),
-        ClarificationQuestion(
-            slot="industry_mapping",
-            question="请选择行业定义",
-            options=["类目行业", "商家行业", "内容行业"],
-            recommended="类目行业",
-        ),
-        ClarificationQuestion(
-            slot="time_semantics",
-            question="请选择时间口径",
-            options=["自然日(UTC+8)", "业务日"],
-            recommended="自然日(UTC+8)",
-        ),
-    ]
+    QUESTION_BANK = QUESTION_BANK
+    QUESTION_BANK_BY_SLOT = QUESTION_BANK_BY_SLOT
 
     def __init__(self, max_questions: int = 3) -> None:
         self.max_questions = max_questions
+        # Slot values only depend on the spec definition, keyed by spec_id; the
+        # owner wires invalidate() to AssetStore.subscribe so edits evict them.
+        self._slot_cache: Dict[str, Dict[str, str]] = {}
 
-    def _slot_values_for_spec(self, spec) -> Dict[str, str]:  # type: ignore[override]
-        values: Dict[str, str] = {}
-        if spec.semantics.metric_caliber:
-            values["metric_caliber"] = spec.semantics.metric_caliber
-        if spec.semantics.industry_mapping:
-            dim_table = spec.semantics.industry_mapping.dim_table
-            values["industry_mapping"] = (
-                "商家行业" if "merchant" in dim_table or "shop" in dim_table else "类目行业"
-            )
-        if spec.semantics.time_semantics:
-            rule = spec.semantics.time_semantics.business_day_rule
-            values["time_semantics"] = "自然日(UTC+8)" if "natural" in rule else "业务日"
-        return values
+    def invalidate(self, spec_id: str | None = None) -> None:
+        """Drop cached slot values for one spec (or all) after it is edited."""
+        if spec_id is None:
+            self._slot_cache.clear()
+        else:
+            self._slot_cache.pop(spec_id, None)
+
+    def _slot_values_for_spec(self, spec: MetricSpec) -> Dict[str, str]:
+        cached = self._slot_cache.get(spec.spec_id)
+        if cached is None:
+            cached = self._slot_cache[spec.spec_id] = slot_values_for_spec(spec)
+        return cached
 
-    def _recommended_value(self, slot: str, state: SessionState) -> str | None:
+    def _recommended_value(
+        self, slot: str, state: SessionState, counters: Dict[str, Counter[str]] | None = None
+    ) -> str | None:
         if state.selected_spec:
             selected_values = self._slot_values_for_spec(state.selected_spec)
             if slot in selected_values:
                 return selected_values[slot]
-        counts: Counter[str] = Counter()
+        if counters is None:
+            counters = self._all_slot_counters(state)
+        if counters.get(slot):
+            return counters[slot].most_common(1)[0][0]
+        question = self.QUESTION_BANK_BY_SLOT.get(slot)
+        return question.recommended if question else None
+
+    def _all_slot_counters(self, state: SessionState) -> Dict[str, Counter[str]]:
+        """Per-slot value counts over all candidates, gathered in one pass."""
+        counters: Dict[str, Counter[str]] = {}
         for candidate in state.candidates:
-            slot_values = self._slot_values_for_spec(candidate.spec)
-            if slot_values.get(slot):
-                counts[slot_values[slot]] += 1
-        if counts:
-            return counts.most_common(1)[0][0]
-        for question in self.QUESTION_BANK:
-            if question.slot == slot:
-                return question.recommended
-        return None
+            for slot, value in self._slot_values_for_spec(candidate.spec).items():
+                counters.setdefault(slot, Counter())[value] += 1
+        return counters
 
     def next_questions(self, state: SessionState) -> List[ClarificationQuestion]:
         asked_slots = set(state.clarifications.keys())
+        counters = self._all_slot_counters(state)
+        # A slot cannot split the candidates into more groups than there are candidates;
+        # once enough questions reach that ceiling, later slots can only tie and lose.
+        ceiling = max(len(state.candidates), 1)
+        saturated = 0
         ranked: List[tuple[int, ClarificationQuestion]] = []
         for question in self.QUESTION_BANK:
+            if saturated >= self.max_questions:
+                break
             if question.slot in asked_slots:
                 continue
-            values = set()
-            for candidate in state.candidates:
-                slot_values = self._slot_values_for_spec(candidate.spec)
-                if question.slot in slot_values:
-                    values.add(slot_values[question.slot])
-            info_gain = len(values)
+            info_gain = len(counters.get(question.slot, ()))
             if info_gain == 0 and state.selected_spec:
                 # Allow confirmation question even if not differentiating
                 info_gain = 1
             if info_gain > 0:
-                recommended = self._recommended_value(question.slot, state)
-                ranked.append((info_gain, ClarificationQuestion(
-                    slot=question.slot,
-                    question=question.question,
-                    options=question.options,
-                    recommended=recommended,
-                )))
+                ranked.append((info_gain, question))
+                if info_gain >= ceiling:
+                    saturated += 1
         ranked.sort(key=lambda item: item[0], reverse=True)
-        return [item[1] for item in ranked[: self.max_questions]]
+        return [
+            ClarificationQuestion(
+                slot=question.slot,
+                question=question.question,
+                options=question.options,
+                recommended=self._recommended_value(question.slot, state, counters),
+            )
+            for _, question in ranked[: self.max_questions]
+        ]
 
     def apply_answers(self, state: SessionState, answers: Iterable[ClarificationAnswer]) -> None:
         for ans in answers:
@@ -102,15 +146,15 @@ class ClarificationEngine:
 
     def slot_form(self, state: SessionState) -> List[Dict[str, str | List[str] | None]]:
         form = []
+        counters = self._all_slot_counters(state)
         for question in self.QUESTION_BANK:
+            answer = state.clarifications.get(question.slot)
             form.append(
                 {
                     "slot": question.slot,
                     "label": question.question,
                     "options": question.options,
-                    "value": state.clarifications.get(question.slot, None).value
-                    if state.clarifications.get(question.slot)
-                    else self._recommended_value(question.slot, state),
+                    "value": answer.value if answer else self._recommended_value(question.slot, state, counters),
                 }
             )
         return form
@@ -1,39 +1,55 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import List, Optional
+import re
+from dataclasses import dataclass, field
+from typing import Callable, FrozenSet, List, Optional, Pattern, Tuple
 
 from .models import ConflictNotice, ConflictOption, ParsedIntent
 
 
-@dataclass
+def _settle_vs_daily() -> ConflictNotice:
+    return ConflictNotice(
+        code="settle_vs_daily",
+        message="检测到潜在冲突：结算口径通常有延迟，按天看波动可能不准确。",
+        options=[
+            ConflictOption(
+                option_id="settle_weekly",
+                label="保持结算口径，粒度改为周",
+                consequence="将时间粒度调整为周以匹配结算滞后",
+                apply_granularity="周",
+            ),
+            ConflictOption(
+                option_id="switch_pay",
+                label="保持日粒度，改用支付口径",
+                consequence="改为支付/下单口径以获得当日数据",
+                apply_metric_caliber="支付",
+            ),
+        ],
+    )
+
+
+# (trigger pattern, conflicting-ask pattern, conflicting granularities, notice factory).
+# A rule fires when the trigger matches and either the query text or the parsed
+# granularity asks for the conflicting view.
+ConflictRule = Tuple[Pattern[str], Pattern[str], FrozenSet[str], Callable[[], ConflictNotice]]
+
+CONFLICT_RULES: List[ConflictRule] = [
+    (re.compile("结算"), re.compile("[日天]"), frozenset({"天", "日"}), _settle_vs_daily),
+]
+
+
+@dataclass(slots=True)
 class ConflictDetector:
     """Simple heuristic conflict detector for ambiguous/contradictory asks."""
 
+    rules: List[ConflictRule] = field(default_factory=lambda: list(CONFLICT_RULES))
+
     def detect(self, intent: ParsedIntent) -> Optional[ConflictNotice]:
-        lowered = intent.raw_query.lower()
+        query = intent.raw_query
         granular = intent.granularity or ""
-        has_settlement = "结算" in intent.raw_query
-        wants_daily = any(token in intent.raw_query for token in ["当日", "当天", "日", "天"]) or granular in {"天", "日"}
-        if has_settlement and wants_daily:
-            return ConflictNotice(
-                code="settle_vs_daily",
-                message="检测到潜在冲突：结算口径通常有延迟，按天看波动可能不准确。",
-                options=[
-                    ConflictOption(
-                        option_id="settle_weekly",
-                        label="保持结算口径，粒度改为周",
-                        consequence="将时间粒度调整为周以匹配结算滞后",
-                        apply_granularity="周",
-                    ),
-                    ConflictOption(
-                        option_id="switch_pay",
-                        label="保持日粒度，改用支付口径",
-                        consequence="改为支付/下单口径以获得当日数据",
-                        apply_metric_caliber="支付",
-                    ),
-                ],
-            )
+        for trigger, conflicting, granularities, build_notice in self.rules:
+            if trigger.search(query) and (granular in granularities or conflicting.search(query)):
+                return build_notice()
         return None
 
 
@@ -6,7 +6,7 @@ from typing import List
 from .models import MetricSpec, SessionState
 
 
-@dataclass
+@dataclass(slots=True)
 class ExpertRouter:
     owners: List[str]
 
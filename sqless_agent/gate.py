@@ -6,7 +6,7 @@ from typing import List
 from .models import Candidate, SessionState
 
 
-@dataclass
+@dataclass(slots=True)
 class UncertaintyGate:
     high_conf_threshold: float = 0.85
     clarifying_threshold: float = 0.65
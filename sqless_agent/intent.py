@@ -1,20 +1,31 @@
 from __future__ import annotations
 
 import re
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 
 from .models import ParsedIntent
 
+DIMENSION_KEYWORDS = ["行业", "类目", "渠道"]
+_DIMENSION_RE = re.compile("|".join(map(re.escape, DIMENSION_KEYWORDS)))
+_TIME_RANGE_RE = re.compile(r"(\d{1,2})月")
+
 
 @dataclass
 class IntentParser:
-    metric_keywords: List[str] = None
+    metric_keywords: Optional[List[str]] = None
+    _lowered: List[Tuple[str, str]] = field(init=False, repr=False)
 
-    def parse(self, query: str) -> ParsedIntent:
+    def __post_init__(self) -> None:
         keywords = self.metric_keywords or ["gmv", "订单", "转化"]
-        metrics = [kw for kw in keywords if kw.lower() in query.lower()]
-        dimensions = [match for match in ["行业", "类目", "渠道"] if match in query]
+        # Lowercase the keywords once; parse() only has to lowercase the query.
+        self._lowered = [(kw, kw.lower()) for kw in keywords]
+
+    def parse(self, query: str) -> ParsedIntent:
+        lowered_query = query.lower()
+        metrics = [kw for kw, lowered in self._lowered if lowered in lowered_query]
+        found_dimensions = set(_DIMENSION_RE.findall(query))
+        dimensions = [match for match in DIMENSION_KEYWORDS if match in found_dimensions]
         time_range = self._extract_time_range(query)
         granularity = "天" if "日" in query or "天" in query else None
         return ParsedIntent(
@@ -26,7 +37,7 @@ class IntentParser:
         )
 
     def _extract_time_range(self, query: str) -> str | None:
-        match = re.search(r"(\d{1,2})月", query)
+        match = _TIME_RANGE_RE.search(query)
         if match:
             return f"最近的 {match.group(1)} 月"
         return None
@@ -2,10 +2,10 @@ from __future__ import annotations
 
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, FrozenSet, List, Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class MetricMeta:
     name: str
     aliases: List[str]
@@ -20,26 +20,26 @@ class MetricMeta:
     tags: List[str] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class Grain:
     time_granularity: str
     dimensions: List[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class TimeSemantics:
     event_time: str
     timezone: str
     business_day_rule: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Filter:
     expr: str
     desc: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class IndustryMapping:
     type: str
     version: str
@@ -47,13 +47,13 @@ class IndustryMapping:
     join_key: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Attribution:
     mode: str
     desc: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Semantics:
     metric_type: str
     default_measure: str
@@ -65,7 +65,7 @@ class Semantics:
     metric_caliber: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class DimensionJoin:
     dim_table: str
     fact_key: str
@@ -73,7 +73,7 @@ class DimensionJoin:
     select_cols: List[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class PhysicalMapping:
     fact_table: str
     time_column: str
@@ -83,7 +83,7 @@ class PhysicalMapping:
     sql_template: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChangelogEntry:
     version: str
     change: str
@@ -91,7 +91,7 @@ class ChangelogEntry:
     at: datetime
 
 
-@dataclass
+@dataclass(slots=True)
 class Governance:
     version: str
     valid_from: datetime
@@ -100,14 +100,14 @@ class Governance:
     conflict_policy: str = "prefer_latest_verified"
 
 
-@dataclass
+@dataclass(slots=True)
 class Security:
     row_level_policy: Optional[str] = None
     column_masking: List[str] = field(default_factory=list)
     allowed_roles: List[str] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class QualityRule:
     type: str
     target: Optional[str] = None
@@ -115,12 +115,12 @@ class QualityRule:
     rule: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Quality:
     validation_rules: List[QualityRule] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class MetricSpec:
     spec_id: str
     meta: MetricMeta
@@ -140,13 +140,13 @@ class MetricSpec:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Candidate:
     spec: MetricSpec
     score: float
 
 
-@dataclass
+@dataclass(slots=True)
 class ParsedIntent:
     raw_query: str
     metrics: List[str]
@@ -156,7 +156,7 @@ class ParsedIntent:
     filters: List[str] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class ClarificationQuestion:
     slot: str
     question: str
@@ -164,13 +164,13 @@ class ClarificationQuestion:
     recommended: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ClarificationAnswer:
     slot: str
     value: str
 
 
-@dataclass
+@dataclass(slots=True)
 class ConflictOption:
     option_id: str
     label: str
@@ -179,19 +179,20 @@ class ConflictOption:
     apply_metric_caliber: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ConflictNotice:
     code: str
     message: str
     options: List[ConflictOption]
 
 
-@dataclass
+@dataclass(slots=True)
 class SessionState:
     session_id: str
     user: str
     intent: ParsedIntent
     candidates: List[Candidate] = field(default_factory=list)
+    candidate_by_id: Dict[str, Candidate] = field(default_factory=dict)
     clarifications: Dict[str, ClarificationAnswer] = field(default_factory=dict)
     selected_spec: Optional[MetricSpec] = None
     confidence: float = 0.0
@@ -200,7 +201,7 @@ class SessionState:
     forwarded_to: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class QueryLogRecord:
     """Raw query log entry prior to cleaning and templating."""
 
@@ -212,7 +213,7 @@ class QueryLogRecord:
     executed_at: datetime
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TableSchema:
     """Minimal schema info for semantic reverse engineering."""
 
@@ -220,7 +221,7 @@ class TableSchema:
     columns: Dict[str, str]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SQLTemplate:
     template: str
     fingerprint: str
@@ -228,7 +229,7 @@ class SQLTemplate:
     parameters: Dict[str, str] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class IntentSQLPair:
     """Cleaned intent-SQL pairing mined from historical logs."""
 
@@ -240,3 +241,5 @@ class IntentSQLPair:
     frequency: int
     authority: float
     recency: float
+    # Filled by IntentSQLStore.add_pairs so a pair is tokenized once.
+    _intent_tokens: FrozenSet[str] = field(default_factory=frozenset, init=False, repr=False, compare=False)
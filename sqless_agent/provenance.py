@@ -1,11 +1,13 @@
 from __future__ import annotations
 
 import hashlib
+import heapq
 import re
-from collections import Counter
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, replace
 from datetime import datetime
-from typing import Dict, Iterable, List, Mapping, Sequence
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple
 
 from .models import IntentSQLPair, QueryLogRecord, SQLTemplate, TableSchema
 
@@ -18,19 +20,23 @@ PII_PATTERNS = [
     re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"),
     re.compile(r"\b\d{15,18}[Xx]?\b"),  # national IDs
 ]
+# All PII patterns in one alternation (same priority order) so masking is a single scan.
+_PII_RE = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in PII_PATTERNS))
 
 
 def mask_pii(sql: str) -> str:
     """Mask common PII patterns before any LLM step."""
 
-    masked = sql
-    for pattern in PII_PATTERNS:
-        masked = pattern.sub("<MASKED>", masked)
-    return masked
+    return _PII_RE.sub("<MASKED>", sql)
 
 
-def tokenize(text: str) -> List[str]:
-    return [t for t in re.split(r"[^a-zA-Z0-9_\u4e00-\u9fff]+", text.lower()) if t]
+_TOKEN_RE = re.compile(r"[a-zA-Z0-9_\u4e00-\u9fff]+")
+
+
+@lru_cache(maxsize=4096)
+def tokenize(text: str) -> Tuple[str, ...]:
+    # Cached, hence a tuple: queries and intents repeat heavily.
+    return tuple(_TOKEN_RE.findall(text.lower()))
 
 
 # --- Phase 1: Filtering ---------------------------------------------------
@@ -42,10 +48,11 @@ class SQLLogFilter:
     min_scanned_rows: int = 1_000
     min_duration_ms: int = 300
 
-    def filter(self, logs: Iterable[QueryLogRecord], authority_whitelist: set[str] | None = None) -> List[QueryLogRecord]:
-        """Heuristic physical-layer filter to discard low-value noise."""
+    def filter(
+        self, logs: Iterable[QueryLogRecord], authority_whitelist: set[str] | None = None
+    ) -> Iterator[QueryLogRecord]:
+        """Heuristic physical-layer filter to discard low-value noise, yielded lazily."""
 
-        filtered: List[QueryLogRecord] = []
         for log in logs:
             if log.status != self.status_success:
                 continue
@@ -55,27 +62,33 @@ class SQLLogFilter:
                 # skip low-authority users in the filtering phase
                 continue
             sanitized_sql = mask_pii(log.sql)
-            filtered.append(
-                QueryLogRecord(
-                    sql=sanitized_sql,
-                    status=log.status,
-                    scanned_rows=log.scanned_rows,
-                    duration_ms=log.duration_ms,
-                    user=log.user,
-                    executed_at=log.executed_at,
-                )
-            )
-        return filtered
+            # Records are frozen, so a log without PII can be passed through as is.
+            yield log if sanitized_sql == log.sql else replace(log, sql=sanitized_sql)
 
 
 # --- Phase 2: Structural Fingerprinting ----------------------------------
 
 
+_LITERAL_RE = re.compile(r"'[^']*'|\b\d{4}-\d{2}-\d{2}\b|\b\d+\b")
+_COMMENT_RE = re.compile(r"--.*?$|/\*.*?\*/", re.MULTILINE | re.DOTALL)
+_TABLE_RE = re.compile(r"\bfrom\s+([\w\.]+)|\bjoin\s+([\w\.]+)", re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+
+
 class SQLTemplateBuilder:
-    def __init__(self) -> None:
-        self.literal_regex = re.compile(r"'[^']*'|\b\d{4}-\d{2}-\d{2}\b|\b\d+\b")
+    def __init__(self, cache_size: int = 8192) -> None:
+        # Query logs repeat the same SQL text heavily; memoize per raw SQL string.
+        self._build_cached = lru_cache(maxsize=cache_size)(self._build_parts)
+
+    def clear_cache(self) -> None:
+        self._build_cached.cache_clear()
 
     def build(self, sql: str) -> SQLTemplate:
+        template, fingerprint, tables, parameters = self._build_cached(sql)
+        # Fresh containers per call so callers never share mutable state through the cache.
+        return SQLTemplate(template=template, fingerprint=fingerprint, tables=list(tables), parameters=dict(parameters))
+
+    def _build_parts(self, sql: str) -> Tuple[str, str, Tuple[str, ...], Tuple[Tuple[str, str], ...]]:
         base_sql = self._strip_comments(sql)
         parameters: Dict[str, str] = {}
         counter = 1
@@ -87,31 +100,52 @@ class SQLTemplateBuilder:
             counter += 1
             return f"{{{placeholder}}}"
 
-        templated = self.literal_regex.sub(replace_literal, base_sql)
+        templated = _LITERAL_RE.sub(replace_literal, base_sql)
         tables = self._extract_tables(base_sql)
         normalized = self._normalize_sql(templated)
-        fingerprint = hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
-        return SQLTemplate(template=normalized, fingerprint=fingerprint, tables=tables, parameters=parameters)
+        # Interned: fingerprints are the hot dict keys of the pipeline reduction.
+        # Only a dedupe key, not a security boundary, so a short non-truncated
+        # BLAKE2b digest replaces SHA-256; unlike hash() it is stable across runs.
+        fingerprint = sys.intern(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).hexdigest())
+        return normalized, fingerprint, tuple(tables), tuple(parameters.items())
 
     def _strip_comments(self, sql: str) -> str:
-        return re.sub(r"--.*?$|/\*.*?\*/", "", sql, flags=re.MULTILINE | re.DOTALL).strip()
+        return _COMMENT_RE.sub("", sql).strip()
 
     def _extract_tables(self, sql: str) -> List[str]:
-        matches = re.findall(r"\bfrom\s+([\w\.]+)|\bjoin\s+([\w\.]+)", sql, flags=re.IGNORECASE)
+        matches = _TABLE_RE.findall(sql)
         tables = {m[0] or m[1] for m in matches if m[0] or m[1]}
         return sorted(tables)
 
     def _normalize_sql(self, sql: str) -> str:
-        squashed = re.sub(r"\s+", " ", sql.strip())
+        squashed = _WS_RE.sub(" ", sql.strip())
         return squashed.lower()
 
 
 # --- Phase 3: Semantic Reverse Engineering --------------------------------
 
 
+# Shared label constants; detectors return tuples of these so callers cannot mutate them.
+_M_DISTINCT = sys.intern("去重用户数")
+_M_COUNT = sys.intern("记录数")
+_M_SUM = sys.intern("金额/求和指标")
+_M_AVG = sys.intern("均值指标")
+_M_DEFAULT = (sys.intern("常规模型查询"),)
+_F_NEW = sys.intern("新客")
+_F_REGION = sys.intern("地区筛选")
+_F_PAID = sys.intern("支付订单")
+
+# One scan per template; "count(distinct" is tried before the bare "count(".
+_MEASURE_RE = re.compile(r"count\(distinct|count\(|sum\(|avg\(")
+_FILTER_RE = re.compile(r"is_new|region|province|pay_status")
+_FILTER_LABELS = {"is_new": _F_NEW, "region": _F_REGION, "province": _F_REGION, "pay_status": _F_PAID}
+_FILTER_LABEL_ORDER = (_F_NEW, _F_REGION, _F_PAID)
+
+
 class SemanticIntentInferer:
     def __init__(self, schemas: Mapping[str, TableSchema] | None = None) -> None:
         self.schemas = {k.lower(): v for k, v in (schemas or {}).items()}
+        self._table_descriptions: Dict[str, str] = {}
 
     def infer(self, template: SQLTemplate) -> str:
         tables = template.tables or ["unknown table"]
@@ -121,12 +155,18 @@ class SemanticIntentInferer:
         parts = []
         if measures:
             parts.append("、".join(measures))
-        parts.append("数据来源" + "、".join(table_descriptions))
+        parts.append(f"数据来源{'、'.join(table_descriptions)}")
         if filters:
-            parts.append("过滤" + "、".join(filters))
+            parts.append(f"过滤{'、'.join(filters)}")
         return "；".join(parts)
 
     def _summarize_table(self, table: str) -> str:
+        description = self._table_descriptions.get(table)
+        if description is None:
+            description = self._table_descriptions[table] = self._describe_table(table)
+        return description
+
+    def _describe_table(self, table: str) -> str:
         schema = self.schemas.get(table.lower())
         if not schema:
             return table
@@ -134,29 +174,26 @@ class SemanticIntentInferer:
         col_desc = "、".join(f"{col}({desc})" for col, desc in important_cols)
         return f"{schema.table}[{col_desc}]"
 
-    def _detect_measures(self, template_sql: str) -> List[str]:
+    def _detect_measures(self, template_sql: str) -> Tuple[str, ...]:
+        found = set(_MEASURE_RE.findall(template_sql))
+        if not found:
+            return _M_DEFAULT
         measures: List[str] = []
-        if "count(distinct" in template_sql:
-            measures.append("去重用户数")
-        elif "count(" in template_sql:
-            measures.append("记录数")
-        if "sum(" in template_sql:
-            measures.append("金额/求和指标")
-        if "avg(" in template_sql:
-            measures.append("均值指标")
-        return measures or ["常规模型查询"]
-
-    def _detect_filters(self, template_sql: str) -> List[str]:
-        filters: List[str] = []
+        if "count(distinct" in found:
+            measures.append(_M_DISTINCT)
+        elif "count(" in found:
+            measures.append(_M_COUNT)
+        if "sum(" in found:
+            measures.append(_M_SUM)
+        if "avg(" in found:
+            measures.append(_M_AVG)
+        return tuple(measures)
+
+    def _detect_filters(self, template_sql: str) -> Tuple[str, ...]:
         if "where" not in template_sql:
-            return filters
-        if "is_new" in template_sql:
-            filters.append("新客")
-        if "region" in template_sql or "province" in template_sql:
-            filters.append("地区筛选")
-        if "pay_status" in template_sql:
-            filters.append("支付订单")
-        return filters
+            return ()
+        found = {_FILTER_LABELS[keyword] for keyword in _FILTER_RE.findall(template_sql)}
+        return tuple(label for label in _FILTER_LABEL_ORDER if label in found)
 
 
 # --- Phase 4: Trust Scoring ----------------------------------------------
@@ -175,17 +212,30 @@ class TrustScorer:
 
     def score(self, frequency: int, max_frequency: int, authority: float, recency_days: float) -> float:
         freq_score = min(frequency / max(max_frequency, 1), 1.0)
+        return round(freq_score * self.weights.frequency + self.log_weight(authority, recency_days), 4)
+
+    def score_batch(
+        self,
+        frequencies: Sequence[int],
+        max_frequency: int,
+        authorities: Sequence[float],
+        recencies: Sequence[float],
+    ) -> List[float]:
+        """score() over parallel columns, as the pipeline scores its template winners."""
+        return [
+            self.score(frequency, max_frequency, authority, recency)
+            for frequency, authority, recency in zip(frequencies, authorities, recencies)
+        ]
+
+    def log_weight(self, authority: float, recency_days: float) -> float:
+        """Authority and recency share of score(), the only part that varies within a template."""
         authority_score = min(max(authority, 0.0), 1.0)
         recency_score = 1.0 / (1.0 + recency_days / 30.0)
-        total = (
-            freq_score * self.weights.frequency
-            + authority_score * self.weights.authority
-            + recency_score * self.weights.recency
-        )
-        return round(total, 4)
+        return authority_score * self.weights.authority + recency_score * self.weights.recency
 
-    def recency_days(self, executed_at: datetime) -> float:
-        return max((datetime.utcnow() - executed_at).days, 0)
+    def recency_days(self, executed_at: datetime, now: datetime | None = None) -> float:
+        now = now or datetime.utcnow()
+        return max((now - executed_at).days, 0)
 
 
 # --- Orchestrator ---------------------------------------------------------
@@ -204,39 +254,52 @@ class SQLProvenancePipeline:
         authority_map: Mapping[str, float] | None = None,
     ) -> List[IntentSQLPair]:
         authority_map = authority_map or {}
+        # Templates are only reused within a run, so earlier logs do not pin memory.
+        self.templater.clear_cache()
         authority_whitelist = {u for u, weight in authority_map.items() if weight >= 0.5}
         cleaned_logs = self.filter.filter(logs, authority_whitelist=authority_whitelist)
 
-        templated_records: List[tuple[QueryLogRecord, SQLTemplate]] = []
+        # Single pass: every log of a template shares the same frequency term, so
+        # the strongest log per template is known before the final counts are.
+        now = datetime.utcnow()
+        fp_counts: Dict[str, int] = {}
+        best_by_fingerprint: Dict[str, tuple[float, QueryLogRecord, SQLTemplate, float, float]] = {}
         for log in cleaned_logs:
-            templated_records.append((log, self.templater.build(log.sql)))
-
-        freq_counter = Counter(tpl.fingerprint for _, tpl in templated_records)
-        max_freq = max(freq_counter.values()) if freq_counter else 1
-        inferer = SemanticIntentInferer(table_schemas)
-        best_by_fingerprint: Dict[str, IntentSQLPair] = {}
-
-        for log, tpl in templated_records:
-            frequency = freq_counter[tpl.fingerprint]
+            tpl = self.templater.build(log.sql)
+            fp_counts[tpl.fingerprint] = fp_counts.get(tpl.fingerprint, 0) + 1
             authority = authority_map.get(log.user, 0.3 if authority_whitelist else 0.2)
-            recency = self.scorer.recency_days(log.executed_at)
-            trust = self.scorer.score(frequency, max_freq, authority, recency)
-            intent = inferer.infer(tpl)
+            recency = self.scorer.recency_days(log.executed_at, now)
+            weight = self.scorer.log_weight(authority, recency)
+            existing = best_by_fingerprint.get(tpl.fingerprint)
+            if existing is None or weight > existing[0]:
+                best_by_fingerprint[tpl.fingerprint] = (weight, log, tpl, authority, recency)
+
+        max_freq = max(fp_counts.values(), default=1)
+        winners = list(best_by_fingerprint.values())
+        frequencies = [fp_counts[tpl.fingerprint] for _, _, tpl, _, _ in winners]
+        trust_scores = self.scorer.score_batch(
+            frequencies,
+            max_freq,
+            [authority for _, _, _, authority, _ in winners],
+            [recency for _, _, _, _, recency in winners],
+        )
+        inferer = SemanticIntentInferer(table_schemas)
+        pairs: List[IntentSQLPair] = []
+        for (_, log, tpl, authority, recency), frequency, trust in zip(winners, frequencies, trust_scores):
             entities = {k: v for k, v in tpl.parameters.items() if k.startswith("param_")}
-            candidate = IntentSQLPair(
-                intent=intent,
-                sql_template=tpl,
-                raw_sql=log.sql,
-                inferred_entities=entities,
-                trust_score=trust,
-                frequency=frequency,
-                authority=authority,
-                recency=recency,
+            pairs.append(
+                IntentSQLPair(
+                    intent=inferer.infer(tpl),
+                    sql_template=tpl,
+                    raw_sql=log.sql,
+                    inferred_entities=entities,
+                    trust_score=trust,
+                    frequency=frequency,
+                    authority=authority,
+                    recency=recency,
+                )
             )
-            existing = best_by_fingerprint.get(tpl.fingerprint)
-            if not existing or candidate.trust_score > existing.trust_score:
-                best_by_fingerprint[tpl.fingerprint] = candidate
-        return list(best_by_fingerprint.values())
+        return pairs
 
 
 # --- Storage & Retrieval --------------------------------------------------
@@ -245,18 +308,41 @@ class SQLProvenancePipeline:
 class IntentSQLStore:
     def __init__(self) -> None:
         self.pairs: List[IntentSQLPair] = []
+        # Inverted index from intent token to pair positions, built once per pair.
+        self._postings: Dict[str, List[int]] = {}
+        # Pair positions by trust (desc), insertion order on ties.
+        self._by_trust: List[int] = []
 
     def add_pairs(self, pairs: Sequence[IntentSQLPair]) -> None:
-        self.pairs.extend(pairs)
+        for pair in pairs:
+            position = len(self.pairs)
+            self.pairs.append(pair)
+            if not pair._intent_tokens:
+                object.__setattr__(pair, "_intent_tokens", frozenset(tokenize(pair.intent)))
+            for token in pair._intent_tokens:
+                self._postings.setdefault(token, []).append(position)
+        self._by_trust = sorted(range(len(self.pairs)), key=lambda i: -self.pairs[i].trust_score)
 
     def retrieve(self, query: str, top_k: int = 5) -> List[IntentSQLPair]:
         query_tokens = set(tokenize(query))
-        scored: List[tuple[float, IntentSQLPair]] = []
-        for pair in self.pairs:
-            intent_tokens = set(tokenize(pair.intent))
-            overlap = len(query_tokens & intent_tokens)
+        overlaps: Dict[int, int] = {}
+        for token in query_tokens:
+            for position in self._postings.get(token, ()):
+                overlaps[position] = overlaps.get(position, 0) + 1
+        scored: List[tuple[float, int]] = []
+        for position, overlap in overlaps.items():
             intent_score = overlap / (len(query_tokens) + 1)
-            total_score = intent_score * 0.6 + pair.trust_score * 0.4
-            scored.append((total_score, pair))
-        scored.sort(key=lambda item: item[0], reverse=True)
-        return [pair for _, pair in scored[:top_k]]
+            total_score = intent_score * 0.6 + self.pairs[position].trust_score * 0.4
+            scored.append((total_score, position))
+        # Pairs sharing no token score on trust alone, so only the top_k most
+        # trusted of them can still make the cut.
+        fillers = 0
+        for position in self._by_trust:
+            if fillers >= top_k:
+                break
+            if position not in overlaps:
+                scored.append((self.pairs[position].trust_score * 0.4, position))
+                fillers += 1
+        # Highest score first, earlier insertion first on ties.
+        top = heapq.nlargest(top_k, scored, key=lambda item: (item[0], -item[1]))
+        return [self.pairs[position] for _, position in top]
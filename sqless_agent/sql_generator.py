@@ -1,19 +1,55 @@
 from __future__ import annotations
 
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
 from .models import MetricSpec, SessionState
 
+DEFAULT_TEMPLATE = (
+    "-- Show Your Work: {fact_table} / {time_column} / {measure_column}\n"
+    "SELECT {time_bucket} AS time_bucket, SUM({measure_column}) AS metric\n"
+    "FROM {fact_table}\n"
+    "WHERE {time_column} IS NOT NULL AND {where_clause}\n"
+    "GROUP BY {time_bucket}\n"
+    "ORDER BY {time_bucket};"
+)
+DEFAULT_TEMPLATE_LINES = DEFAULT_TEMPLATE.split("\n")
+
 
 class SQLGenerator:
-    def render(self, spec: MetricSpec, state: SessionState) -> str:
-        slots: Dict[str, str] = {
+    def __init__(self) -> None:
+        # spec_id -> (governance version, spec-level slots, spec filter expressions)
+        self._spec_cache: Dict[str, Tuple[str, Dict[str, str], List[str]]] = {}
+
+    def invalidate(self, spec_id: Optional[str] = None) -> None:
+        """Drop cached spec slots for one spec (or all) after it is edited in place."""
+        if spec_id is None:
+            self._spec_cache.clear()
+        else:
+            self._spec_cache.pop(spec_id, None)
+
+    def _spec_slots(self, spec: MetricSpec) -> Tuple[Dict[str, str], List[str]]:
+        """Slots that depend only on the spec, rebuilt when its governance version changes."""
+        cached = self._spec_cache.get(spec.spec_id)
+        if cached is not None and cached[0] == spec.governance.version:
+            return cached[1], cached[2]
+        slots = {
             "time_bucket": spec.semantics.grain.time_granularity,
             "fact_table": spec.physical.fact_table,
             "time_column": spec.physical.time_column,
             "measure_column": spec.physical.measure_column,
         }
-        where_parts = [f.expr for f in spec.semantics.filters]
+        filters = [f.expr for f in spec.semantics.filters]
+        self._spec_cache[spec.spec_id] = (spec.governance.version, slots, filters)
+        return slots, filters
+
+    def _slots(self, spec: MetricSpec, state: Optional[SessionState]) -> Dict[str, str]:
+        spec_slots, where_parts = self._spec_slots(spec)
+        if state is not None:
+            where_parts = where_parts + self._session_where_parts(state)
+        return {**spec_slots, "where_clause": "\n    AND ".join(where_parts) if where_parts else "1=1"}
+
+    def _session_where_parts(self, state: SessionState) -> List[str]:
+        where_parts: List[str] = []
         if state.intent.time_range:
             where_parts.append(f"-- 时间范围: {state.intent.time_range}")
         if state.clarifications.get("metric_caliber"):
@@ -22,13 +58,23 @@ class SQLGenerator:
             where_parts.append(f"-- 行业映射: {state.clarifications['industry_mapping'].value}")
         if state.clarifications.get("time_semantics"):
             where_parts.append(f"-- 时间口径: {state.clarifications['time_semantics'].value}")
-        where_clause = "\n    AND ".join(where_parts) if where_parts else "1=1"
-        template = spec.physical.sql_template or (
-            "-- Show Your Work: {fact_table} / {time_column} / {measure_column}\n"
-            "SELECT {time_bucket} AS time_bucket, SUM({measure_column}) AS metric\n"
-            "FROM {fact_table}\n"
-            "WHERE {time_column} IS NOT NULL AND {where_clause}\n"
-            "GROUP BY {time_bucket}\n"
-            "ORDER BY {time_bucket};"
-        )
-        return template.format(where_clause=where_clause, **slots)
+        return where_parts
+
+    def render(self, spec: MetricSpec, state: Optional[SessionState] = None) -> str:
+        """Render SQL for ``spec``; without a session only the spec's own filters apply."""
+        template = spec.physical.sql_template or DEFAULT_TEMPLATE
+        return template.format(**self._slots(spec, state))
+
+    def render_preview(
+        self, spec: MetricSpec, state: Optional[SessionState] = None, max_lines: int = 4
+    ) -> List[str]:
+        """First ``max_lines`` lines of ``render``, formatting only the template lines needed."""
+        if spec.physical.sql_template:
+            return self.render(spec, state).splitlines()[:max_lines]
+        slots = self._slots(spec, state)
+        lines: List[str] = []
+        for template_line in DEFAULT_TEMPLATE_LINES:
+            lines.extend(template_line.format(**slots).splitlines())
+            if len(lines) >= max_lines:
+                break
+        return lines[:max_lines]
@@ -1,54 +1,200 @@
 from __future__ import annotations
 
+import heapq
+import sys
+import threading
 from dataclasses import dataclass, field
-from typing import Dict, Iterable, List, Optional, Tuple
+from functools import lru_cache
+from operator import itemgetter
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
 
+from .clarification import slot_values_for_spec
 from .models import Candidate, MetricSpec
 
+VERIFIED = "verified"
 
-@dataclass
+
+def search_tokens(spec: MetricSpec) -> FrozenSet[str]:
+    """Casefolded name, alias and tag tokens used for candidate matching."""
+    meta = spec.meta
+    return frozenset(token.casefold() for token in (meta.name, *meta.aliases, *meta.tags))
+
+
+def score_base(spec: MetricSpec) -> float:
+    """Query-independent part of a candidate score: freshness plus capped usage bonus."""
+    freshness = 1.0 if spec.meta.status == VERIFIED else 0.85
+    usage_bonus = min(spec.meta.usage_count / 100.0, 0.1)
+    return freshness * 0.3 + usage_bonus
+
+
+def make_scorer(overlaps: Dict[str, int], score_bases: Dict[str, float]) -> Callable[[MetricSpec], float]:
+    """Bind one query's overlaps so scoring a spec is a closure call, not a method lookup chain."""
+
+    def score(spec: MetricSpec) -> float:
+        spec_id = spec.spec_id
+        return overlaps.get(spec_id, 0) * 0.6 + score_bases[spec_id]
+
+    return score
+
+
+def build_preview(spec: MetricSpec) -> Dict[str, object]:
+    """Session-independent display fields for a spec (summary, slot labels, filters)."""
+    return {
+        "summary": spec.summary(),
+        "friendly_slots": slot_values_for_spec(spec),
+        "filter_labels": [f.desc or f.expr for f in spec.semantics.filters],
+    }
+
+
+@dataclass(slots=True)
 class AssetStore:
     """In-memory hot/cold asset storage for MetricSpec objects."""
 
-    cold_specs: Dict[str, MetricSpec] = field(default_factory=dict)
-    hot_specs: Dict[str, MetricSpec] = field(default_factory=dict)
+    # One dict for every spec; the tier is a tag, so lookups and scans touch one table.
+    specs: Dict[str, MetricSpec] = field(default_factory=dict)
+    # Insertion rank of each spec_id, i.e. its place in get_all() order.
+    positions: Dict[str, int] = field(default_factory=dict, repr=False)
+    hot_ids: Set[str] = field(default_factory=set)
+    cold_ids: Set[str] = field(default_factory=set)
+    # Match tokens are derived once at insert time instead of on every retrieval.
+    token_index: Dict[str, FrozenSet[str]] = field(default_factory=dict, repr=False)
+    # Inverted index: token -> spec_ids carrying it.
+    postings: Dict[str, Set[str]] = field(default_factory=dict, repr=False)
+    previews: Dict[str, Dict[str, object]] = field(default_factory=dict, repr=False)
+    # score_base per spec_id, refreshed only when status or usage changes it.
+    score_bases: Dict[str, float] = field(default_factory=dict, repr=False)
+    # Bumped on every change that can affect ranking; part of the retrieval cache key.
+    version: int = 0
+    _all_specs: Optional[Tuple[MetricSpec, ...]] = field(default=None, init=False, repr=False, compare=False)
+    # Serializes usage bumps and verifications from concurrent request threads.
+    _write_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+    # Called with the spec_id whenever a spec is (re)indexed, so caches outside
+    # the store that derive from spec definitions can drop their entry.
+    _listeners: List[Callable[[str], None]] = field(default_factory=list, init=False, repr=False, compare=False)
 
     def add_cold(self, spec: MetricSpec) -> None:
-        self.cold_specs[spec.spec_id] = spec
+        self.specs[spec.spec_id] = spec
+        self.hot_ids.discard(spec.spec_id)
+        self.cold_ids.add(spec.spec_id)
+        self._index(spec)
 
     def add_hot(self, spec: MetricSpec) -> None:
-        self.hot_specs[spec.spec_id] = spec
+        self.specs[spec.spec_id] = spec
+        self.cold_ids.discard(spec.spec_id)
+        self.hot_ids.add(spec.spec_id)
+        self._index(spec)
+
+    def _index(self, spec: MetricSpec) -> None:
+        self.version += 1
+        self.positions.setdefault(spec.spec_id, len(self.positions))
+        self._all_specs = None
+        # Interned so the per-query status check against VERIFIED is an identity hit.
+        spec.meta.status = sys.intern(spec.meta.status)
+        # Re-adding a spec_id replaces its derived data, so edits are picked up.
+        for token in self.token_index.get(spec.spec_id, ()):
+            self.postings[token].discard(spec.spec_id)
+        tokens = self.token_index[spec.spec_id] = search_tokens(spec)
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(spec.spec_id)
+        self.previews[spec.spec_id] = build_preview(spec)
+        self.score_bases[spec.spec_id] = score_base(spec)
+        for listener in self._listeners:
+            listener(spec.spec_id)
+
+    def subscribe(self, listener: Callable[[str], None]) -> None:
+        """Register ``listener(spec_id)`` to run after a spec is added or replaced."""
+        self._listeners.append(listener)
+
+    def get(self, spec_id: str) -> Optional[MetricSpec]:
+        return self.specs.get(spec_id)
 
-    def get_all(self) -> Iterable[MetricSpec]:
-        yield from self.cold_specs.values()
-        yield from self.hot_specs.values()
+    def get_all(self) -> Tuple[MetricSpec, ...]:
+        # A snapshot tuple: fastest to iterate, and safe to scan while specs are added.
+        if self._all_specs is None:
+            self._all_specs = tuple(self.specs.values())
+        return self._all_specs
 
     def mark_verified(self, spec_id: str) -> None:
-        if spec_id in self.hot_specs:
-            self.hot_specs[spec_id].meta.status = "verified"
+        if spec_id in self.hot_ids:
+            spec = self.specs[spec_id]
+            with self._write_lock:
+                spec.meta.status = VERIFIED
+                self.score_bases[spec_id] = score_base(spec)
+                self.version += 1
 
     def bump_usage(self, spec_id: str) -> None:
-        spec = self.hot_specs.get(spec_id) or self.cold_specs.get(spec_id)
+        spec = self.specs.get(spec_id)
         if spec:
-            spec.meta.usage_count += 1
+            with self._write_lock:
+                spec.meta.usage_count += 1
+                # The usage bonus saturates at 10 uses; past that ranking is unaffected.
+                if spec.meta.usage_count <= 10:
+                    self.score_bases[spec_id] = score_base(spec)
+                    self.version += 1
 
 
 class CandidateSelector:
-    def __init__(self, store: AssetStore) -> None:
+    def __init__(self, store: AssetStore, cache_size: int = 256) -> None:
         self.store = store
+        # Agents re-ask the same intents; the store version keys out stale rankings.
+        self._ranked_cached = lru_cache(maxsize=cache_size)(self._ranked)
+
+    def retrieve(self, keywords: FrozenSet[str], top_k: int = 5) -> List[Candidate]:
+        """Rank specs for ``keywords``, which the caller has already casefolded."""
+        ranked = self._ranked_cached(keywords, top_k, self.store.version)
+        return [Candidate(spec=spec, score=score) for score, spec in ranked]
+
+    def retrieve_raw(self, intent_keywords: Iterable[str], top_k: int = 5) -> List[Candidate]:
+        """``retrieve`` for keywords that still need normalizing."""
+        return self.retrieve(frozenset(k.casefold() for k in intent_keywords), top_k)
+
+    def _ranked(self, keywords: FrozenSet[str], top_k: int, version: int) -> Tuple[Tuple[float, MetricSpec], ...]:
+        """Top-k (score, spec) pairs; ``version`` is unused here and only keys the cache."""
+        # Overlap is counted straight off the postings of each keyword, so no
+        # per-spec set is built; specs under no keyword have zero overlap.
+        overlaps: Dict[str, int] = {}
+        for keyword in keywords:
+            for spec_id in self.store.postings.get(keyword, ()):
+                overlaps[spec_id] = overlaps.get(spec_id, 0) + 1
+        # One shared keyword (0.6) outweighs the whole score base range
+        # (0.255-0.4), so every matched spec outranks every unmatched one.
+        specs, positions = self.store.specs, self.store.positions
+        matched = [specs[spec_id] for spec_id in sorted(overlaps, key=positions.__getitem__)]
+        score = make_scorer(overlaps, self.store.score_bases)
+        # nlargest matches a stable descending sort, so ties keep store order.
+        top = heapq.nlargest(top_k, ((score(spec), spec) for spec in matched), key=itemgetter(0))
+        if len(top) < top_k:
+            top.extend(self._best_unmatched(overlaps, top_k - len(top)))
+        return tuple(top)
+
+    def _best_unmatched(self, overlaps: Dict[str, int], count: int) -> List[Tuple[float, MetricSpec]]:
+        """The ``count`` best specs sharing no keyword; they score on their base alone."""
+        store = self.store
+        score_bases, positions = store.score_bases, store.positions
+        # Min-heap of (base, -position, spec_id): the root is the weakest kept entry,
+        # and on equal bases the later spec is the weaker one, as in store order.
+        heap: List[Tuple[float, int, str]] = []
+        hot_ids = store.hot_ids
+        # Hot specs go first: they tend to carry the high bases, so the floor
+        # rises early. Cold specs then stream in store order straight off
+        # score_bases, and most are rejected on a single float comparison.
+        for spec_id in hot_ids:
+            if spec_id not in overlaps:
+                self._offer(heap, count, score_bases[spec_id], -positions[spec_id], spec_id)
+        floor = heap[0][0] if len(heap) == count else -1.0
+        for spec_id, base in score_bases.items():
+            if base < floor or spec_id in overlaps or spec_id in hot_ids:
+                continue
+            self._offer(heap, count, base, -positions[spec_id], spec_id)
+            if len(heap) == count:
+                floor = heap[0][0]
+        heap.sort(reverse=True)
+        return [(base, store.specs[spec_id]) for base, _, spec_id in heap]
 
-    def retrieve(self, intent_keywords: List[str], top_k: int = 5) -> List[Candidate]:
-        scored: List[Tuple[MetricSpec, float]] = []
-        keywords = {k.lower() for k in intent_keywords}
-        for spec in self.store.get_all():
-            score = self._score_spec(spec, keywords)
-            scored.append((spec, score))
-        scored.sort(key=lambda item: item[1], reverse=True)
-        return [Candidate(spec=s, score=score) for s, score in scored[:top_k]]
-
-    def _score_spec(self, spec: MetricSpec, keywords: set[str]) -> float:
-        name_tokens = {spec.meta.name.lower(), *[a.lower() for a in spec.meta.aliases], *spec.meta.tags}
-        overlap = len(keywords.intersection(name_tokens))
-        freshness = 1.0 if spec.meta.status == "verified" else 0.85
-        usage_bonus = min(spec.meta.usage_count / 100.0, 0.1)
-        return overlap * 0.6 + freshness * 0.3 + usage_bonus
+    @staticmethod
+    def _offer(heap: List[Tuple[float, int, str]], count: int, base: float, rank: int, spec_id: str) -> None:
+        entry = (base, rank, spec_id)
+        if len(heap) < count:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)